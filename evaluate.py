@@ -1,8 +1,8 @@
 import os
-import json
+import orjson
+import asyncio
 from pathlib import Path
 from dotenv import load_dotenv
-import time
 
 # --- SETUP ---
 # Load environment variables first
@@ -10,50 +10,69 @@ env_path = Path('.') / '.env'
 load_dotenv(dotenv_path=env_path)
 
 # Import our RAG services AFTER loading env vars
-from services.query_service import retrieve_and_rerank, generate_answer_with_gemini
+from services.query_service import retrieve_and_rerank, generate_answer_with_gemini_async
 from services.evaluation_service import run_evaluation_pipeline
+from services.rate_limiter import RateLimiter
+from services.embedding_service import document_id_from_url
+
+# Cap on questions processed at once, and on Gemini calls per minute
+MAX_CONCURRENCY = int(os.getenv("EVAL_MAX_CONCURRENCY", "8"))
+MAX_RPM = int(os.getenv("GEMINI_MAX_RPM", "15"))
+# URL of the (already indexed) document the golden dataset is about; retrieval is limited to it.
+# Without it the whole index is searched with dense vectors only.
+EVAL_DOCUMENT_URL = os.getenv("EVAL_DOCUMENT_URL")
+EVAL_DOCUMENT_ID = document_id_from_url(EVAL_DOCUMENT_URL) if EVAL_DOCUMENT_URL else None
+
+async def run_rag_for_item(item: dict, semaphore: asyncio.Semaphore, rate_limiter: RateLimiter) -> dict:
+    """
+    Runs retrieval and generation for a single golden dataset item.
+    """
+    question = item['question']
+    async with semaphore:
+        print(f"\nProcessing question: '{question}'")
+
+        # a. Retrieve and re-rank context (includes the query rewrite call)
+        await rate_limiter.acquire()
+        retrieved_context = await retrieve_and_rerank(question, document_id=EVAL_DOCUMENT_ID)
+
+        # b. Generate an answer
+        await rate_limiter.acquire()
+        generated_answer = await generate_answer_with_gemini_async(question, retrieved_context)
+
+    return {
+        "question": question,
+        "generated_answer": generated_answer,
+        "retrieved_context": retrieved_context,
+        "ground_truth_answer": item.get("ground_truth_answer"),
+        "ground_truth_context": item.get("ground_truth_context")
+    }
 
 # --- MAIN EXECUTION ---
-def main():
+async def main():
     """
     Main function to orchestrate the evaluation process.
     """
     # 1. Load the golden dataset
     print("Loading golden dataset...")
-    with open('golden_dataset.json', 'r', encoding='utf-8') as f:
-        golden_dataset = json.load(f)
+    with open('golden_dataset.json', 'rb') as f:
+        golden_dataset = orjson.loads(f.read())
     print(f"Loaded {len(golden_dataset)} test items.")
 
-    # 2. Run the RAG pipeline for each question in the dataset
-    print("\n--- Running RAG Pipeline on Golden Dataset ---")
-    results_with_context = []
-    for item in golden_dataset:
-        question = item['question']
-        print(f"\nProcessing question: '{question}'")
-        
-        # a. Retrieve and re-rank context
-        retrieved_context = retrieve_and_rerank(question)
-        
-        # b. Generate an answer
-        generated_answer = generate_answer_with_gemini(question, retrieved_context)
-        
-        results_with_context.append({
-            "question": question,
-            "generated_answer": generated_answer,
-            "retrieved_context": retrieved_context,
-            "ground_truth_answer": item.get("ground_truth_answer"),
-            "ground_truth_context": item.get("ground_truth_context")
-        })
-        # Small delay to avoid hitting API rate limits
-        time.sleep(1) 
+    # 2. Run the RAG pipeline for every question in the dataset concurrently
+    print(f"\n--- Running RAG Pipeline on Golden Dataset (concurrency={MAX_CONCURRENCY}, max_rpm={MAX_RPM}) ---")
+    semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+    rate_limiter = RateLimiter(MAX_RPM)
+    results_with_context = list(await asyncio.gather(
+        *(run_rag_for_item(item, semaphore, rate_limiter) for item in golden_dataset)
+    ))
 
     # 3. Run the evaluation pipeline on the results
-    evaluation_results = run_evaluation_pipeline(results_with_context)
+    evaluation_results = await run_evaluation_pipeline(results_with_context, max_concurrent=MAX_CONCURRENCY, rate_limiter=rate_limiter)
 
     # 4. Save the detailed results to a file
     output_filename = "evaluation_results.json"
-    with open(output_filename, 'w', encoding='utf-8') as f:
-        json.dump(evaluation_results, f, indent=4)
+    with open(output_filename, 'wb') as f:
+        f.write(orjson.dumps(evaluation_results, option=orjson.OPT_INDENT_2))
         
     print(f"\nEvaluation complete. Detailed results saved to '{output_filename}'.")
 
@@ -62,4 +81,4 @@ if __name__ == "__main__":
     # Before running, ensure the document has been processed and embedded
     # For this script, we assume the Pinecone index is already populated.
     # You can run the main FastAPI app once to process the document first.
-    main()
+    asyncio.run(main())
@@ -1,4 +1,5 @@
 import os
+import asyncio
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -9,16 +10,32 @@ env_path = Path('.') / '.env'
 load_dotenv(dotenv_path=env_path)
 
 from fastapi import FastAPI, HTTPException, Header
+from fastapi.middleware.gzip import GZipMiddleware
 from pydantic import BaseModel, HttpUrl
 from typing import List, Optional
+# Models are loaded at import time (services/models.py). Only the torch backend may be shared
+# through `gunicorn --preload`: ONNX Runtime and OpenVINO create their inference thread pools
+# when the model is loaded, and a forked worker inherits a pool whose threads do not exist.
 from services.embedding_service import process_and_embed_document
-from services.query_service import answer_question
+from services.query_service import answer_questions_batch, warmup as warmup_models
+from services.http_client import close_http_session
 
 app = FastAPI(
     title="LLM-Powered Intelligent Query–Retrieval System",
     description="An API that processes documents and answers questions using a RAG pipeline with Gemini.",
     version="1.0.0"
 )
+# Compress responses for clients that accept gzip (bodies under 1 KB are sent as-is)
+app.add_middleware(GZipMiddleware, minimum_size=1000)
+
+@app.on_event("startup")
+async def startup():
+    # Runs in each worker, so torch creates its intra-op thread pool after the fork, not in the master
+    await asyncio.to_thread(warmup_models)
+
+@app.on_event("shutdown")
+async def shutdown():
+    await close_http_session()
 
 class RunRequest(BaseModel):
     documents: HttpUrl
@@ -36,12 +53,10 @@ async def run_submission(
         raise HTTPException(status_code=401, detail="Authorization header with Bearer token is required.")
 
     try:
-        process_and_embed_document(str(request.documents))
+        document_id = await process_and_embed_document(str(request.documents))
 
-        answers = []
-        for question in request.questions:
-            generated_answer = answer_question(question)
-            answers.append(generated_answer)
+        # Retrieval is restricted to the sections of this request's document
+        answers = await answer_questions_batch(request.questions, document_id)
         
         return RunResponse(answers=answers)
 
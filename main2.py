@@ -1,10 +1,10 @@
 import os
-import json
-import requests
-import tempfile
+import io
+import orjson
 from pathlib import Path
 from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException, Header
+from fastapi.middleware.gzip import GZipMiddleware
 from pydantic import BaseModel, HttpUrl
 from typing import List, Optional
 import uuid
@@ -15,6 +15,7 @@ env_path = Path('.') / '.env'
 load_dotenv(dotenv_path=env_path)
 
 import google.generativeai as genai
+from services.http_client import download_bytes, close_http_session
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 if not GEMINI_API_KEY:
@@ -29,12 +30,20 @@ app = FastAPI(
     description="An API that intelligently processes any PDF and answers questions using a single, consolidated LLM call.",
     version="3.2.0" # Version updated for new logging logic
 )
+# Compress responses for clients that accept gzip (bodies under 1 KB are sent as-is)
+app.add_middleware(GZipMiddleware, minimum_size=1000)
 
-# --- Create a directory to store downloaded PDFs ---
+# --- Create a directory to store request logs ---
+# PDFs themselves are kept in memory and uploaded to Gemini directly.
 PDF_DOWNLOAD_DIR = "downloaded_pdfs"
 os.makedirs(PDF_DOWNLOAD_DIR, exist_ok=True)
 
 
+@app.on_event("shutdown")
+async def shutdown():
+    await close_http_session()
+
+
 # --- CORE PROMPT TEMPLATE ---
 
 MASTER_PROMPT_TEMPLATE_FILE = """
@@ -99,20 +108,15 @@ async def run_submission(
         print(f"  {i+1}. {q}")
     print("--------------------------\n")
     
-    # --- Download to a permanent folder and prepare log path ---
+    # --- Prepare log path ---
     request_id = str(uuid.uuid4())
-    pdf_path = os.path.join(PDF_DOWNLOAD_DIR, f"{request_id}.pdf")
     log_path = os.path.join(PDF_DOWNLOAD_DIR, f"{request_id}_log.txt")
     
     try:
-        # 1. Download the document to the new folder
-        print(f"Downloading document to {pdf_path}...")
-        with requests.get(str(request.documents), stream=True) as r:
-            r.raise_for_status()
-            with open(pdf_path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
-        print("Download complete.")
+        # 1. Download the document into memory
+        print("Downloading document...")
+        pdf_bytes = await download_bytes(str(request.documents))
+        print(f"Download complete ({len(pdf_bytes)} bytes).")
 
         # --- ADDED: Write request details to a log file ---
         with open(log_path, 'w', encoding='utf-8') as log_file:
@@ -125,7 +129,11 @@ async def run_submission(
         
         # 2. Upload the file to the Gemini API
         print("Uploading PDF file to Gemini for multimodal analysis...")
-        uploaded_file = genai.upload_file(path=pdf_path, display_name=os.path.basename(pdf_path))
+        uploaded_file = genai.upload_file(
+            path=io.BytesIO(pdf_bytes),
+            mime_type="application/pdf",
+            display_name=f"{request_id}.pdf"
+        )
 
         # 3. Format the questions and construct the prompt
         questions_list_str = "\n".join([f"{i+1}. {q}" for i, q in enumerate(request.questions)])
@@ -139,7 +147,7 @@ async def run_submission(
 
         # 5. Clean and parse the JSON response from the model
         response_text = response.text.strip().replace("```json", "").replace("```", "").strip()
-        response_json = json.loads(response_text)
+        response_json = orjson.loads(response_text)
         
         print("Successfully received and parsed response from Gemini.")
         
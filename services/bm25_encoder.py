@@ -0,0 +1,87 @@
+import os
+import joblib
+import numpy as np
+from sklearn.feature_extraction.text import HashingVectorizer
+
+# --- CONFIGURATION ---
+# Hashed vocabulary: every term maps to a fixed sparse index, so no vocabulary
+# has to be fitted or stored alongside the parameters.
+N_FEATURES = 2 ** 20
+TOKEN_PATTERN = r"\b\w+\b"
+# IDF statistics are fitted per document and stored as <BM25_PARAMS_DIR>/<document_id>.joblib,
+# so concurrent requests and workers never encode queries with another document's parameters.
+BM25_PARAMS_DIR = os.getenv("BM25_PARAMS_DIR", "bm25_params")
+
+def bm25_params_path(document_id: str) -> str:
+    return os.path.join(BM25_PARAMS_DIR, f"{document_id}.joblib")
+
+
+class BM25SparseEncoder:
+    """
+    Okapi BM25 encoder producing Pinecone sparse vectors.
+    The corpus is tokenized once into a CSR term-frequency matrix; document
+    term weights and query IDF weights are computed with vectorized NumPy/SciPy
+    operations instead of per-token Python loops.
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.idf = None
+        self.avgdl = None
+        self._vectorizer = HashingVectorizer(
+            n_features=N_FEATURES,
+            token_pattern=TOKEN_PATTERN,
+            lowercase=True,
+            alternate_sign=False,
+            norm=None
+        )
+
+    def _term_frequencies(self, texts):
+        tf = self._vectorizer.transform(texts).tocsr()
+        tf.sum_duplicates()
+        return tf
+
+    def fit(self, texts):
+        tf = self._term_frequencies(texts)
+        n_docs = tf.shape[0]
+        doc_freq = np.bincount(tf.indices, minlength=N_FEATURES)
+        self.idf = np.log((n_docs - doc_freq + 0.5) / (doc_freq + 0.5) + 1).astype(np.float32)
+        self.avgdl = float(tf.sum() / max(n_docs, 1))
+        return self
+
+    def encode_documents(self, texts) -> list[dict]:
+        """Per-document BM25 term-frequency weights; IDF is applied on the query side."""
+        tf = self._term_frequencies(texts)
+        doc_lengths = np.asarray(tf.sum(axis=1)).ravel()
+        denom = self.k1 * (1 - self.b + self.b * doc_lengths / self.avgdl)
+        rows = np.repeat(np.arange(tf.shape[0]), np.diff(tf.indptr))
+        weights = tf.data * (self.k1 + 1) / (tf.data + denom[rows])
+
+        return [
+            {
+                "indices": tf.indices[start:end].tolist(),
+                "values": weights[start:end].tolist()
+            }
+            for start, end in zip(tf.indptr[:-1], tf.indptr[1:])
+        ]
+
+    def encode_queries(self, text: str) -> dict:
+        """IDF weights of the query terms, normalized to sum to 1."""
+        indices = np.unique(self._vectorizer.transform([text]).indices)
+        idf = self.idf[indices]
+        total = idf.sum()
+        values = idf / total if total > 0 else idf
+        return {"indices": indices.tolist(), "values": values.tolist()}
+
+    def dump(self, path: str):
+        joblib.dump({"k1": self.k1, "b": self.b, "avgdl": self.avgdl, "idf": self.idf}, path)
+
+    @classmethod
+    def load(cls, path: str):
+        # The IDF table is memory-mapped rather than copied into each process
+        params = joblib.load(path, mmap_mode='r')
+        encoder = cls(k1=params["k1"], b=params["b"])
+        encoder.avgdl = params["avgdl"]
+        encoder.idf = params["idf"]
+        return encoder
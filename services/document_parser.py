@@ -1,64 +1,153 @@
 import os
+import math
+import multiprocessing
 import joblib
-import pandas as pd
-from .feature_extractor import extract_features_from_pdf
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from .feature_extractor import extract_features_for_pages, get_page_count
 
 HEADING_HIERARCHY = {
     "Title": 0, "H1": 1, "H2": 2, "H3": 3, "H4": 4, "H5": 5, "H6": 6
 }
-
-def group_text_into_sections(labeled_lines, pdf_filename):
+# Levels for non-heading labels; headings use their HEADING_HIERARCHY level (>= 0)
+BODY_LEVEL = -1
+SKIP_LEVEL = -2
+
+# Below this many pages, process start-up and model loading cost more than they save
+PARALLEL_MIN_PAGES = 16
+
+def build_level_lut(label_encoder):
+    """
+    Maps each encoded class index to its heading level, BODY_LEVEL or SKIP_LEVEL,
+    so predictions can be turned into levels with one array lookup.
+    """
+    lut = np.full(len(label_encoder.classes_), SKIP_LEVEL, dtype=np.int8)
+    for idx, label in enumerate(label_encoder.classes_):
+        if label in HEADING_HIERARCHY:
+            lut[idx] = HEADING_HIERARCHY[label]
+        elif label == 'Body':
+            lut[idx] = BODY_LEVEL
+    return lut
+
+def close_section(section):
+    # Lines are already whitespace-normalized by the feature extractor, so a single join suffices
+    section['content'] = ' '.join(section.pop('content_parts'))
+    section['full_content'] = section['path'] + ": " + section['content']
+    return section
+
+def group_text_into_sections(texts, levels, page_nums, pdf_filename):
+    """
+    Groups lines into heading-delimited sections. `levels` holds one integer per
+    line: a heading level (>= 0), BODY_LEVEL, or SKIP_LEVEL for ignored lines.
+    """
     sections = []
     current_section = None
+    # Each entry keeps the " > "-joined path up to and including that heading,
+    # so a new section's path is one concatenation onto its parent's.
     active_heading_stack = []
 
-    for item in labeled_lines:
-        label = item.get('label')
-        text = item.get('text', '').strip()
-        page_num = item.get('page')
-
+    for text, heading_level, page_num in zip(texts, levels, page_nums):
+        text = text.strip()
         if not text:
             continue
 
-        is_heading = label in HEADING_HIERARCHY
-
-        if is_heading:
+        if heading_level >= 0:
             if current_section:
-                current_section['content'] = ' '.join(current_section['content'].split())
-                sections.append(current_section)
+                sections.append(close_section(current_section))
 
-            heading_level = HEADING_HIERARCHY[label]
-            
             while active_heading_stack and active_heading_stack[-1]['level'] >= heading_level:
                 active_heading_stack.pop()
+
+            path_str = active_heading_stack[-1]['path'] + " > " + text if active_heading_stack else text
             
             current_section = {
                 "document_name": pdf_filename,
                 "page_number": page_num,
                 "section_title": text,
-                "content": "",
+                "content_parts": [],
                 "hierarchy_level": heading_level,
-                "full_path": [h['title'] for h in active_heading_stack] + [text]
+                "path": path_str
             }
-            active_heading_stack.append({'title': text, 'level': heading_level})
+            active_heading_stack.append({'path': path_str, 'level': heading_level})
 
-        elif label == 'Body' and current_section:
-            current_section['content'] += f" {text}"
+        elif heading_level == BODY_LEVEL and current_section:
+            current_section['content_parts'].append(text)
     
     if current_section:
-        current_section['content'] = ' '.join(current_section['content'].split())
-        sections.append(current_section)
-
-    return sections
+        sections.append(close_section(current_section))
 
-def add_full_content_to_sections(sections):
-    for section in sections:
-        path_str = " > ".join(section["full_path"])
-        section["full_content"] = f"{path_str}: {section['content']}"
     return sections
 
-def parse_document_to_sections(pdf_path, model_path, encoder_path):
-    pdf_filename = os.path.basename(pdf_path)
+# --- LINE CLASSIFICATION ---
+def classify_lines(model, features_list):
+    """
+    Predicts the encoded label of every extracted line. Returns three aligned
+    arrays (texts, page numbers, encoded predictions) rather than dicts, so
+    results from worker processes are cheap to pickle.
+    """
+    if not features_list:
+        return np.array([], dtype=object), np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+
+    # sklearn records feature_names_in_ only for some versions; LightGBM always keeps feature_name_
+    model_features = getattr(model, 'feature_names_in_', None)
+    if model_features is None:
+        model_features = getattr(model, 'feature_name_', None)
+    if model_features is None:
+        model_features = [col for col in features_list[0] if col not in ['text', 'page_num', 'block_num', 'line_num']]
+    model_features = list(model_features)
+
+    # Column-wise arrays straight from the feature dicts; features the extractor
+    # does not produce are filled with zeros.
+    n_lines = len(features_list)
+    X_predict = np.stack([
+        np.fromiter((f.get(col, 0) for f in features_list), dtype=np.float64, count=n_lines)
+        for col in model_features
+    ], axis=1)
+    texts = np.array([f['text'] for f in features_list], dtype=object)
+    page_nums = np.fromiter((f['page_num'] for f in features_list), dtype=np.int64, count=n_lines)
+
+    return texts, page_nums, model.predict(X_predict)
+
+# Worker-process state: the classifier is loaded once per worker by the pool initializer
+_worker_model = None
+
+def _load_model(model_path):
+    global _worker_model
+    _worker_model = joblib.load(model_path)
+
+def _classify_page_range(pdf_source, page_range):
+    return classify_lines(_worker_model, extract_features_for_pages(pdf_source, page_range))
+
+def classify_pdf_lines(pdf_source, model, model_path):
+    """
+    Extracts and classifies every line of the PDF. Large documents are split
+    into page ranges that are processed in parallel worker processes.
+    """
+    n_pages = get_page_count(pdf_source)
+    n_workers = min(os.cpu_count() or 1, math.ceil(n_pages / PARALLEL_MIN_PAGES))
+
+    if n_workers <= 1:
+        return classify_lines(model, extract_features_for_pages(pdf_source))
+
+    chunk_size = math.ceil(n_pages / n_workers)
+    page_ranges = [range(start, min(start + chunk_size, n_pages)) for start in range(0, n_pages, chunk_size)]
+    print(f"Extracting features from {n_pages} pages with {len(page_ranges)} worker processes...")
+
+    # "spawn" rather than fork: this runs inside a threaded server process
+    mp_context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=len(page_ranges), mp_context=mp_context, initializer=_load_model, initargs=(model_path,)) as executor:
+        results = list(executor.map(_classify_page_range, [pdf_source] * len(page_ranges), page_ranges))
+
+    texts, page_nums, predictions_encoded = (np.concatenate(arrays) for arrays in zip(*results))
+    return texts, page_nums, predictions_encoded
+
+def parse_document_to_sections(pdf_source, model_path, encoder_path, pdf_filename=None):
+    """
+    Parses a PDF, given as a file path or as the raw bytes of the file, into
+    heading-delimited sections. `pdf_filename` names in-memory documents.
+    """
+    if pdf_filename is None:
+        pdf_filename = os.path.basename(pdf_source)
     print(f"Processing '{pdf_filename}'...")
 
     try:
@@ -68,39 +157,18 @@ def parse_document_to_sections(pdf_path, model_path, encoder_path):
         print(f"Error loading model/encoder: {e}")
         return None
 
-    features_list = extract_features_from_pdf(pdf_path)
-    if not features_list:
+    texts, page_nums, predictions_encoded = classify_pdf_lines(pdf_source, model, model_path)
+    if len(texts) == 0:
         print("Could not extract any features from the PDF.")
         return None
-    
-    df = pd.DataFrame(features_list)
-    
-    try:
-        model_features = model.feature_names_in_
-    except AttributeError:
-        model_features = [col for col in df.columns if col not in ['text', 'page_num', 'block_num', 'line_num']]
 
-    for col in model_features:
-        if col not in df.columns:
-            df[col] = 0
-            
-    X_predict = df[model_features]
-
-    predictions_encoded = model.predict(X_predict)
-    predictions_labels = label_encoder.inverse_transform(predictions_encoded)
-    df['predicted_label'] = predictions_labels
-
-    labeled_lines = []
-    for _, row in df.iterrows():
-        if row['predicted_label'] != 'Other':
-            labeled_lines.append({
-                "label": row['predicted_label'],
-                "text": row['text'],
-                "page": int(row['page_num'])
-            })
+    # Encoded predictions map straight to integer levels; no string labels are materialized
+    levels = build_level_lut(label_encoder)[predictions_encoded]
+    mask = levels != SKIP_LEVEL
     
-    structured_sections = group_text_into_sections(labeled_lines, pdf_filename)
-    final_sections = add_full_content_to_sections(structured_sections)
+    final_sections = group_text_into_sections(
+        texts[mask].tolist(), levels[mask].tolist(), page_nums[mask].tolist(), pdf_filename
+    )
     
     print(f"Successfully parsed into {len(final_sections)} sections.")
     
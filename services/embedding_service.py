@@ -1,56 +1,53 @@
 import os
-import requests
-import uuid
-import tempfile
-from contextlib import contextmanager
+import asyncio
+import hashlib
+import threading
+from urllib.parse import urlparse
 from tqdm.auto import tqdm
-from pinecone import Pinecone, ServerlessSpec
-from sentence_transformers import SentenceTransformer
+from pinecone import ServerlessSpec
+from pinecone.grpc import PineconeGRPC as Pinecone
+from .bm25_encoder import BM25SparseEncoder, bm25_params_path
 from .document_parser import parse_document_to_sections
+from .http_client import download_bytes
+from .models import embedding_model
 import re
 
 # --- CONFIGURATION ---
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
 PINECONE_INDEX_NAME = os.getenv("PINECONE_INDEX_NAME", "rag-challenge-index")
-EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+EMBEDDING_ENCODE_BATCH_SIZE = 256
+UPSERT_BATCH_SIZE = 150
+UPSERT_MAX_IN_FLIGHT = 8
+DELETE_BATCH_SIZE = 1000 # Pinecone's limit on ids per delete request
 PINECONE_ENVIRONMENT = os.getenv("PINECONE_ENVIRONMENT", "aws-us-east-1") 
 
 # --- INITIALIZATION ---
 pc = Pinecone(api_key=PINECONE_API_KEY)
 
-print(f"Loading embedding model: {EMBEDDING_MODEL_NAME}...")
-embedding_model = SentenceTransformer(EMBEDDING_MODEL_NAME)
 EMBEDDING_DIMENSION = embedding_model.get_sentence_embedding_dimension()
-print(f"Model loaded. Embedding dimension: {EMBEDDING_DIMENSION}")
+print(f"Embedding dimension: {EMBEDDING_DIMENSION}")
 
 # --- HELPER FUNCTIONS ---
-@contextmanager
-def temporary_pdf_file(url):
-    temp_dir = tempfile.gettempdir()
-    local_filename = os.path.join(temp_dir, f"{uuid.uuid4()}.pdf")
-    print(f"Downloading PDF from {url} to {local_filename}...")
-    try:
-        with requests.get(url, stream=True) as r:
-            r.raise_for_status()
-            with open(local_filename, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
-        print("Download complete.")
-        yield local_filename
-    finally:
-        if os.path.exists(local_filename):
-            os.remove(local_filename)
-            print(f"Removed temporary file: {local_filename}")
+def document_name_from_url(url):
+    """Uses the file name in the URL path (e.g. 'policy.pdf') as the document name."""
+    return os.path.basename(urlparse(url).path) or "document.pdf"
+
+def document_id_from_url(url):
+    """
+    Stable ID of the document at `url`. Its vectors are tagged with it in Pinecone
+    and its BM25 parameters are stored under it, so queries stay within one document.
+    """
+    return hashlib.blake2b(url.encode("utf-8"), digest_size=8).hexdigest()
 
 # --- PINEONE INDEX MANAGEMENT ---
 def get_pinecone_index():
-    """Gets or creates a Pinecone serverless index."""
+    """Gets or creates a Pinecone serverless index suitable for sparse-dense (hybrid) vectors."""
     if PINECONE_INDEX_NAME not in pc.list_indexes().names():
         print(f"Index '{PINECONE_INDEX_NAME}' not found. Creating a new serverless one...")
         pc.create_index(
             name=PINECONE_INDEX_NAME,
             dimension=EMBEDDING_DIMENSION,
-            metric="cosine", 
+            metric="dotproduct", # Required for sparse-dense vectors; equals cosine for our normalized embeddings
             spec=ServerlessSpec(
                 cloud="aws",
                 region=PINECONE_ENVIRONMENT
@@ -59,57 +56,139 @@ def get_pinecone_index():
         print(f"Index '{PINECONE_INDEX_NAME}' created successfully.")
     else:
         print(f"Found existing index: '{PINECONE_INDEX_NAME}'.")
+        metric = pc.describe_index(PINECONE_INDEX_NAME).metric
+        if metric != "dotproduct":
+            raise ValueError(
+                f"Index '{PINECONE_INDEX_NAME}' uses the '{metric}' metric, but hybrid search requires 'dotproduct'. "
+                "Delete the index (or set PINECONE_INDEX_NAME to a new one) so it can be recreated."
+            )
     return pc.Index(PINECONE_INDEX_NAME)
 
-# --- DENSE VECTOR UPSERT LOGIC ---
-def upsert_dense_embeddings(index, sections, batch_size=50):
+# --- HYBRID VECTOR UPSERT LOGIC ---
+def content_hash(text: str) -> str:
+    """Stable (cross-process) 64-bit hash of a section's content."""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=8).hexdigest()
+
+def fit_bm25_encoder(texts, document_id):
+    """Fits BM25 on the document's section texts and publishes the parameters for the query side."""
+    bm25_encoder = BM25SparseEncoder().fit(texts)
+    params_path = bm25_params_path(document_id)
+    os.makedirs(os.path.dirname(params_path), exist_ok=True)
+    # Write-then-rename so query_service never reads a half-written file; the temporary
+    # name is unique per process and thread in case the same document is indexed concurrently
+    tmp_path = f"{params_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    bm25_encoder.dump(tmp_path)
+    os.replace(tmp_path, params_path)
+    return bm25_encoder
+
+def delete_stale_vectors(index, document_id, keep_ids):
     """
-    Creates dense vectors and upserts them to Pinecone.
+    Deletes the document's vectors whose IDs are not in `keep_ids`, i.e. sections
+    that no longer exist in the current version of the document. IDs are listed by
+    their "<document_id>#" prefix.
     """
-    print(f"Starting dense embedding generation and upsert for {len(sections)} sections...")
-    
-    for i in tqdm(range(0, len(sections), batch_size), desc="Upserting to Pinecone"):
-        batch_sections = sections[i:i + batch_size]
-        
-        dense_texts = [section['full_content'] for section in batch_sections]
-        dense_embeddings = embedding_model.encode(dense_texts, show_progress_bar=False).tolist()
-        
-        vectors_to_upsert = []
-        for idx, section in enumerate(batch_sections):
-            vector_id = f"dense_{i+idx}" # Use a simple unique ID
-            metadata = {
-                "document_name": section["document_name"],
-                "page_number": int(section["page_number"]),
-                "section_title": section["section_title"],
-                "full_content": section["full_content"]
+    stale_ids = [
+        vector_id
+        for page in index.list(prefix=f"{document_id}#")
+        for vector_id in page
+        if vector_id not in keep_ids
+    ]
+    for start in range(0, len(stale_ids), DELETE_BATCH_SIZE):
+        index.delete(ids=stale_ids[start:start + DELETE_BATCH_SIZE])
+    if stale_ids:
+        print(f"Deleted {len(stale_ids)} stale vectors of document {document_id}.")
+
+def upsert_hybrid_embeddings(index, sections, document_id, batch_size=UPSERT_BATCH_SIZE, max_in_flight=UPSERT_MAX_IN_FLIGHT):
+    """
+    Creates dense and BM25 sparse vectors and upserts them to Pinecone, tagged
+    with `document_id` so that queries can be filtered to this document.
+    All sections are encoded in a single call; upserts are sent over gRPC with
+    up to `max_in_flight` batches in flight at once.
+    """
+    # Sections with identical content within the document map to the same vector; encode each of them only once
+    unique_sections = {}
+    for section in sections:
+        unique_sections.setdefault(content_hash(section['full_content']), section)
+    hashes = list(unique_sections)
+    # Scoped to the document, so identical sections of different documents stay separate vectors
+    vector_ids = [f"{document_id}#{section_hash}" for section_hash in hashes]
+    sections = list(unique_sections.values())
+
+    # Sections left over from an earlier version of the document would still match the
+    # document filter, with sparse weights computed from BM25 parameters that are being replaced
+    delete_stale_vectors(index, document_id, set(vector_ids))
+    print(f"Starting hybrid embedding generation and upsert for {len(sections)} sections...")
+
+    texts = [section['full_content'] for section in sections]
+    dense_embeddings = embedding_model.encode(texts, batch_size=EMBEDDING_ENCODE_BATCH_SIZE, show_progress_bar=False)
+    sparse_embeddings = fit_bm25_encoder(texts, document_id).encode_documents(texts)
+
+    batches = []
+    for i in range(0, len(sections), batch_size):
+        batch_embeddings = dense_embeddings[i:i + batch_size].tolist()
+        batches.append([
+            {
+                "id": vector_ids[i + idx],
+                "values": embedding,
+                # Pinecone rejects empty sparse vectors (e.g. sections made only of stop words)
+                **({"sparse_values": sparse} if sparse["indices"] else {}),
+                "metadata": {
+                    "document_id": document_id,
+                    "document_name": section["document_name"],
+                    "page_number": int(section["page_number"]),
+                    "section_title": section["section_title"],
+                    "full_content": section["full_content"],
+                    "content_hash": hashes[i + idx]
+                }
             }
-            
-            vectors_to_upsert.append({
-                "id": vector_id,
-                "values": dense_embeddings[idx],
-                "metadata": metadata
-            })
-            
-        index.upsert(vectors=vectors_to_upsert)
+            for idx, (section, embedding, sparse) in enumerate(zip(
+                sections[i:i + batch_size], batch_embeddings, sparse_embeddings[i:i + batch_size]
+            ))
+        ])
+
+    with tqdm(total=len(batches), desc="Upserting to Pinecone") as progress:
+        for start in range(0, len(batches), max_in_flight):
+            futures = [index.upsert(vectors=batch, async_req=True) for batch in batches[start:start + max_in_flight]]
+            for future in futures:
+                future.result()
+                progress.update(1)
         
     print("All sections have been embedded and upserted to Pinecone.")
 
 # --- MAIN ORCHESTRATION ---
-def process_and_embed_document(pdf_url: str):
+async def process_and_embed_document(pdf_url: str) -> str:
+    """
+    Downloads, parses and indexes the PDF at `pdf_url`. Returns its document ID,
+    which retrieval uses to search only this document's sections.
+    """
+    document_id = document_id_from_url(pdf_url)
     print("-" * 80)
     print(f"Starting full processing pipeline for document at: {pdf_url}")
     model_path = "models/heading_classifier_model.joblib"
     encoder_path = "models/label_encoder.joblib"
 
-    with temporary_pdf_file(pdf_url) as local_pdf_path:
-        sections = parse_document_to_sections(local_pdf_path, model_path, encoder_path)
-        if not sections:
-            print("No sections were parsed from the document. Aborting.")
-            return
+    # The PDF is parsed straight from memory; nothing is written to disk
+    print(f"Downloading PDF from {pdf_url}...")
+    pdf_bytes = await download_bytes(pdf_url)
+    print(f"Download complete ({len(pdf_bytes)} bytes).")
 
-        index = get_pinecone_index()
-        
-        upsert_dense_embeddings(index, sections)
+    # Parsing and embedding are CPU-bound; keep them off the event loop
+    sections = await asyncio.to_thread(
+        parse_document_to_sections, pdf_bytes, model_path, encoder_path, document_name_from_url(pdf_url)
+    )
+    index = await asyncio.to_thread(get_pinecone_index)
+
+    if not sections:
+        print("No sections were parsed from the document. Removing anything indexed from an earlier version.")
+        await asyncio.to_thread(delete_stale_vectors, index, document_id, set())
+        try:
+            os.remove(bm25_params_path(document_id))
+        except FileNotFoundError:
+            pass
+        return document_id
+    
+    await asyncio.to_thread(upsert_hybrid_embeddings, index, sections, document_id)
 
     print("Document processing pipeline finished successfully.")
     print("-" * 80)
+    return document_id
@@ -1,8 +1,12 @@
 import os
+import asyncio
 import google.generativeai as genai
-import time
-import json
-from tqdm.auto import tqdm
+from google.api_core.exceptions import ResourceExhausted
+import orjson
+import numpy as np
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
+from tqdm.asyncio import tqdm
+from .rate_limiter import RateLimiter
 
 # --- CONFIGURATION & INITIALIZATION ---
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
@@ -11,6 +15,10 @@ genai.configure(api_key=GEMINI_API_KEY)
 # Use a specific model for evaluation tasks
 evaluation_model = genai.GenerativeModel('gemini-1.5-flash-latest')
 
+MAX_CONCURRENT_EVALUATIONS = int(os.getenv("EVAL_MAX_CONCURRENCY", "8"))
+GEMINI_MAX_RPM = int(os.getenv("GEMINI_MAX_RPM", "15"))
+METRIC_KEYS = ["faithfulness", "answer_relevance", "context_precision"]
+
 # --- CONSOLIDATED EVALUATION PROMPT ---
 # This new prompt asks the LLM to evaluate all metrics in a single call
 # and return a structured JSON object.
@@ -46,7 +54,21 @@ Your response MUST be a valid JSON object with the following structure:
 
 # --- EVALUATION FUNCTIONS ---
 
-def evaluate_single_item(item: dict) -> dict:
+@retry(
+    retry=retry_if_exception_type(ResourceExhausted),
+    wait=wait_exponential(multiplier=2, min=4, max=60),
+    stop=stop_after_attempt(5),
+    reraise=True
+)
+async def generate_scores(prompt: str, rate_limiter: RateLimiter):
+    """
+    Calls the evaluation model, backing off exponentially when the quota is exhausted (HTTP 429).
+    Every attempt, retries included, goes through the requests-per-minute limiter.
+    """
+    await rate_limiter.acquire()
+    return await evaluation_model.generate_content_async(prompt)
+
+async def evaluate_single_item(item: dict, semaphore: asyncio.Semaphore, rate_limiter: RateLimiter) -> dict:
     """
     Runs all evaluations for a single item from the dataset using a single, consolidated LLM call.
     """
@@ -60,59 +82,50 @@ def evaluate_single_item(item: dict) -> dict:
         answer=answer
     )
 
-    scores = {
-        "faithfulness": 0.0,
-        "answer_relevance": 0.0,
-        "context_precision": 0.0
-    }
+    scores = {key: 0.0 for key in METRIC_KEYS}
 
     try:
-        print("    Scoring all metrics with a single API call...")
-        response = evaluation_model.generate_content(prompt)
+        async with semaphore:
+            response = await generate_scores(prompt, rate_limiter)
         
         # Clean the response to extract only the JSON part
         json_response_str = response.text.strip().replace("```json", "").replace("```", "").strip()
         
         # Parse the JSON response
-        parsed_scores = json.loads(json_response_str)
+        parsed_scores = orjson.loads(json_response_str)
         
-        scores["faithfulness"] = float(parsed_scores.get("faithfulness", 0.0))
-        scores["answer_relevance"] = float(parsed_scores.get("answer_relevance", 0.0))
-        scores["context_precision"] = float(parsed_scores.get("context_precision", 0.0))
+        for key in METRIC_KEYS:
+            scores[key] = float(parsed_scores.get(key, 0.0))
 
-    except (json.JSONDecodeError, ValueError, Exception) as e:
+    except (orjson.JSONDecodeError, ValueError, Exception) as e:
         print(f"Warning: Could not parse JSON scores from LLM response. Defaulting to 0. Error: {e}")
         # The scores will remain 0.0 as initialized
     
     item['scores'] = scores
     return item
 
-def run_evaluation_pipeline(results_with_context: list) -> dict:
+async def run_evaluation_pipeline(results_with_context: list, max_concurrent: int = MAX_CONCURRENT_EVALUATIONS, rate_limiter: RateLimiter = None) -> dict:
     """
-    Runs the full evaluation pipeline on a list of RAG outputs.
+    Runs the full evaluation pipeline on a list of RAG outputs, scoring up to
+    `max_concurrent` items at once within the Gemini requests-per-minute quota.
     """
     print(f"\n--- Starting Evaluation Pipeline for {len(results_with_context)} items ---")
     
-    detailed_results = []
-    
-    for item in tqdm(results_with_context, desc="Evaluating RAG performance"):
-        evaluated_item = evaluate_single_item(item)
-        detailed_results.append(evaluated_item)
-        # Add a delay to stay well within the requests-per-minute limit
-        time.sleep(4)
+    semaphore = asyncio.Semaphore(max_concurrent)
+    rate_limiter = rate_limiter or RateLimiter(GEMINI_MAX_RPM)
+    detailed_results = await tqdm.gather(
+        *(evaluate_single_item(item, semaphore, rate_limiter) for item in results_with_context),
+        desc="Evaluating RAG performance"
+    )
 
     # Calculate average scores
     if not detailed_results:
         return {"summary_scores": {}, "detailed_results": []}
 
-    avg_faithfulness = sum(item['scores']['faithfulness'] for item in detailed_results) / len(detailed_results)
-    avg_answer_relevance = sum(item['scores']['answer_relevance'] for item in detailed_results) / len(detailed_results)
-    avg_context_precision = sum(item['scores']['context_precision'] for item in detailed_results) / len(detailed_results)
+    averages = np.mean(np.array([[item['scores'][key] for key in METRIC_KEYS] for item in detailed_results]), axis=0)
 
     summary = {
-        "average_faithfulness": round(avg_faithfulness, 3),
-        "average_answer_relevance": round(avg_answer_relevance, 3),
-        "average_context_precision": round(avg_context_precision, 3)
+        f"average_{key}": round(float(avg), 3) for key, avg in zip(METRIC_KEYS, averages)
     }
 
     print("\n--- Evaluation Summary ---")
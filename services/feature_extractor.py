@@ -43,19 +43,51 @@ def get_page_stats(page):
 
     return body_font_size, avg_vertical_space, size_rank_map
 
-def extract_features_from_pdf(pdf_path):
+def open_pdf(pdf_source):
+    """Opens a PDF given either a file path or the raw bytes of the file."""
+    if isinstance(pdf_source, (bytes, bytearray, memoryview)):
+        return fitz.open(stream=pdf_source, filetype="pdf")
+    return fitz.open(pdf_source)
+
+def describe_pdf_source(pdf_source):
+    if isinstance(pdf_source, (bytes, bytearray, memoryview)):
+        return f"in-memory PDF ({len(pdf_source)} bytes)"
+    return pdf_source
+
+def get_page_count(pdf_source):
+    """Returns the number of pages in a PDF, or 0 if it cannot be opened."""
+    try:
+        with open_pdf(pdf_source) as doc:
+            return doc.page_count
+    except Exception as e:
+        print(f"Error opening {describe_pdf_source(pdf_source)}: {e}")
+        return 0
+
+def extract_features_from_pdf(pdf_source):
     """
     Extracts a detailed feature vector for each TEXT LINE in a PDF.
+    `pdf_source` is a file path or the raw bytes of the file.
+    """
+    return extract_features_for_pages(pdf_source)
+
+def extract_features_for_pages(pdf_source, page_range=None):
+    """
+    Extracts a detailed feature vector for each TEXT LINE on the pages in
+    `page_range` (all pages if None). All features are page-local, so page
+    ranges can be processed independently.
     """
     try:
-        doc = fitz.open(pdf_path)
+        doc = open_pdf(pdf_source)
     except Exception as e:
-        print(f"Error opening {pdf_path}: {e}")
+        print(f"Error opening {describe_pdf_source(pdf_source)}: {e}")
         return []
 
     all_lines_features = []
+    if page_range is None:
+        page_range = range(doc.page_count)
 
-    for page_num, page in enumerate(doc):
+    for page_num in page_range:
+        page = doc[page_num]
         body_font_size, avg_vertical_space, size_rank_map = get_page_stats(page)
         
         page_width = page.rect.width if page.rect.width > 0 else 1.0
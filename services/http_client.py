@@ -0,0 +1,50 @@
+import asyncio
+import aiohttp
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+
+# --- CONFIGURATION ---
+# Separate connect and read timeouts: fail fast on unreachable hosts, tolerate slow bodies
+DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(sock_connect=5, sock_read=60)
+DOWNLOAD_MAX_RETRIES = 3
+RETRY_STATUS_CODES = {502, 503, 504}
+
+# --- SHARED SESSION ---
+# Created lazily because an aiohttp session must be bound to the running event loop.
+_session = None
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Returns the shared aiohttp session, creating it on first use."""
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=32, ttl_dns_cache=300)
+        _session = aiohttp.ClientSession(connector=connector)
+    return _session
+
+async def close_http_session():
+    """Closes the shared session. Call this on application shutdown."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+# --- DOWNLOAD HELPERS ---
+def _is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status in RETRY_STATUS_CODES
+    return isinstance(exc, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+
+@retry(
+    retry=retry_if_exception(_is_retryable),
+    wait=wait_exponential(multiplier=0.5),
+    stop=stop_after_attempt(DOWNLOAD_MAX_RETRIES + 1),
+    reraise=True
+)
+async def download_bytes(url: str) -> bytes:
+    """
+    Downloads the body of `url` into memory without blocking the event loop.
+    Gateway errors, dropped connections and timeouts are retried with exponential backoff.
+    """
+    session = get_http_session()
+    async with session.get(url, timeout=DOWNLOAD_TIMEOUT) as resp:
+        resp.raise_for_status()
+        return await resp.read()
@@ -0,0 +1,31 @@
+import os
+os.environ.setdefault("HF_HUB_DOWNLOAD_TIMEOUT", "120")
+
+from sentence_transformers import SentenceTransformer, CrossEncoder
+
+# --- CONFIGURATION ---
+# Model selection lives here only, so embedding_service (documents) and query_service
+# (queries) always embed into the same vector space.
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+CROSS_ENCODER_MODEL_NAME = "cross-encoder/ms-marco-MiniLM-L6-v2"
+# int8-quantized exports shipped with both models on the Hugging Face Hub, per backend ("torch" runs FP32)
+QUANTIZED_MODEL_FILES = {
+    "onnx": "onnx/model_quint8_avx2.onnx",
+    "openvino": "openvino/openvino_model_qint8_quantized.xml",
+}
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "onnx")
+EMBEDDING_MODEL_FILE = os.getenv("EMBEDDING_MODEL_FILE", QUANTIZED_MODEL_FILES.get(EMBEDDING_BACKEND))
+RERANK_BACKEND = os.getenv("RERANK_BACKEND", "onnx")
+RERANK_MODEL_FILE = os.getenv("RERANK_MODEL_FILE", QUANTIZED_MODEL_FILES.get(RERANK_BACKEND))
+
+def load_model(model_class, model_name, backend, model_file):
+    """Loads a SentenceTransformer or CrossEncoder on the requested inference backend."""
+    print(f"Loading model: {model_name} (backend: {backend})...")
+    if backend in QUANTIZED_MODEL_FILES:
+        return model_class(model_name, backend=backend, model_kwargs={"file_name": model_file})
+    return model_class(model_name)
+
+# --- INITIALIZATION ---
+# One instance of each model per process, shared by the services
+embedding_model = load_model(SentenceTransformer, EMBEDDING_MODEL_NAME, EMBEDDING_BACKEND, EMBEDDING_MODEL_FILE)
+rerank_model = load_model(CrossEncoder, CROSS_ENCODER_MODEL_NAME, RERANK_BACKEND, RERANK_MODEL_FILE)
@@ -1,47 +1,121 @@
 import os
-os.environ["HF_HUB_DOWNLOAD_TIMEOUT"] = "120"
-
+import asyncio
+from functools import lru_cache
+import torch
 import google.generativeai as genai
 from pinecone import Pinecone
-from sentence_transformers import SentenceTransformer, CrossEncoder
-import re
-from rank_bm25 import BM25Okapi
-import json
+from .bm25_encoder import BM25SparseEncoder, bm25_params_path
+import orjson
+from .lru_cache import LRUCache
+from .models import embedding_model, rerank_model
 
 # --- CONFIGURATION & INITIALIZATION ---
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 PINECONE_INDEX_NAME = os.getenv("PINECONE_INDEX_NAME", "rag-challenge-index")
-EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
-CROSS_ENCODER_MODEL_NAME = "cross-encoder/ms-marco-MiniLM-L6-v2" 
+RERANK_BATCH_SIZE = 32
+# Candidates scoring below this fraction of the best hybrid score are not worth re-ranking
+RERANK_MIN_SCORE_RATIO = 0.5
+# Per-document BM25 encoders kept in memory
+BM25_ENCODER_CACHE_SIZE = 32
+# Weight of the dense vector in hybrid queries (1.0 = dense only, 0.0 = sparse only)
+HYBRID_ALPHA = float(os.getenv("HYBRID_ALPHA", "0.5"))
 
 genai.configure(api_key=GEMINI_API_KEY)
 
 pc = Pinecone(api_key=PINECONE_API_KEY)
-embedding_model = SentenceTransformer(EMBEDDING_MODEL_NAME)
-rerank_model = CrossEncoder(CROSS_ENCODER_MODEL_NAME)
 generation_model = genai.GenerativeModel('gemini-1.5-flash-latest')
 
-# --- IN-MEMORY BM25 SETUP ---
-bm25_index = None
-corpus = []
-
-def build_bm25_index_from_file(filepath="golden_dataset.json"):
-    """Builds the in-memory BM25 index from the document context."""
-    global bm25_index, corpus
-    print("Building in-memory BM25 index for keyword search...")
-    with open(filepath, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-    
-    corpus = [item['ground_truth_context'] for item in data]
-    tokenized_corpus = [simple_tokenizer(doc) for doc in corpus]
-    bm25_index = BM25Okapi(tokenized_corpus)
-    print("BM25 index built successfully.")
+# --- QUERY CACHES ---
+# Repeated questions skip the embedding model and sparse encoding entirely
+CACHE_MAX_ENTRIES = 10_000
+query_embedding_cache = LRUCache(maxsize=CACHE_MAX_ENTRIES)
+sparse_query_cache = LRUCache(maxsize=CACHE_MAX_ENTRIES)
+
+# --- WARMUP ---
+def warmup():
+    """
+    Runs one throwaway embedding and rerank pass so the inference sessions are
+    initialized before the first request. The embedding model is shared with
+    embedding_service, so this warms up indexing too. Bypasses the query caches.
+    """
+    embedding_model.encode(["warm up"], show_progress_bar=False)
+    score_rerank_pairs(tokenize_rerank_pairs("warm up", ["warm up"]))
+
+# --- PINECONE INDEX HANDLE ---
+# Resolved once and reused; constructing a handle re-fetches the index host.
+pinecone_index_handle = None
+
+def get_pinecone_index():
+    global pinecone_index_handle
+    if pinecone_index_handle is None:
+        pinecone_index_handle = pc.Index(PINECONE_INDEX_NAME)
+    return pinecone_index_handle
+
+# --- BM25 QUERY ENCODER ---
+# Keyword matching happens inside Pinecone on sparse vectors; only the query
+# side of each document's encoder lives here, reloaded whenever that document is re-indexed.
+bm25_encoders = LRUCache(maxsize=BM25_ENCODER_CACHE_SIZE)
+
+def get_bm25_encoder(document_id: str):
+    """Returns the BM25 encoder fitted on the given document, or None if it has not been indexed."""
+    params_path = bm25_params_path(document_id)
+    try:
+        mtime = os.path.getmtime(params_path)
+    except FileNotFoundError:
+        return None
+
+    cached = bm25_encoders.get(document_id)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    print(f"Loading BM25 parameters from '{params_path}'...")
+    encoder = BM25SparseEncoder.load(params_path)
+    bm25_encoders.put(document_id, (mtime, encoder))
+    if cached is not None:
+        # The document was re-indexed; sparse vectors encoded with its old parameters are stale
+        sparse_query_cache.clear()
+    return encoder
 
 # --- HELPER FUNCTIONS ---
-def simple_tokenizer(text):
-    """A simple tokenizer to split text into words."""
-    return re.findall(r'\b\w+\b', text.lower())
+def encode_queries(texts: list[str]) -> list[list[float]]:
+    """
+    Embeds query strings, serving repeats from the LRU cache and encoding all
+    misses in a single batch.
+    """
+    embeddings = [query_embedding_cache.get(text) for text in texts]
+    misses = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if misses:
+        encoded = embedding_model.encode([texts[i] for i in misses], batch_size=32, show_progress_bar=False).tolist()
+        for i, embedding in zip(misses, encoded):
+            query_embedding_cache.put(texts[i], embedding)
+            embeddings[i] = embedding
+    return embeddings
+
+def encode_sparse_queries(texts: list[str], document_id: str = None) -> list:
+    """
+    Encodes query strings into BM25 sparse vectors with the given document's
+    parameters (None when there is no document, it has not been indexed, or
+    the query has no tokens at all; terms unseen in the document still get
+    their IDF weight).
+    """
+    encoder = get_bm25_encoder(document_id) if document_id else None
+    if encoder is None:
+        return [None for _ in texts]
+
+    sparse_vectors = []
+    for text in texts:
+        sparse_vector = sparse_query_cache.get((document_id, text))
+        if sparse_vector is None:
+            sparse_vector = encoder.encode_queries(text)
+            sparse_query_cache.put((document_id, text), sparse_vector)
+        sparse_vectors.append(sparse_vector if sparse_vector["indices"] else None)
+    return sparse_vectors
+
+def hybrid_scale(dense: list[float], sparse: dict, alpha: float):
+    """Convex combination of dense and sparse query vectors, as expected by Pinecone's dotproduct hybrid search."""
+    scaled_sparse = {"indices": sparse["indices"], "values": [v * (1 - alpha) for v in sparse["values"]]}
+    return [v * alpha for v in dense], scaled_sparse
 
 # --- PROMPT TEMPLATES ---
 REWRITE_PROMPT_TEMPLATE = """
@@ -71,106 +145,252 @@ QUESTION:
 ANSWER:
 """
 
+# Answers every question of a request in a single Gemini call
+BATCH_ANSWER_PROMPT_TEMPLATE = """
+You are an expert assistant for a document query system. Your task is to answer each of the user's questions based on the context provided for that question.
+Each answer must be concise and directly address its question, using only the most relevant sentences from its context.
+Do not use any external knowledge. But use your common sense. If the context for a question does not contain the answer, you must state that you don't have enough information.
+
+{question_sections}
+
+Your response MUST be a single valid JSON object with the following structure, with exactly one answer per question, in the same order as the questions:
+{{
+  "answers": [
+    "string"
+  ]
+}}
+"""
+
+QUESTION_SECTION_TEMPLATE = """QUESTION {number}:
+{question}
+
+CONTEXT FOR QUESTION {number}:
+---
+{context}
+---
+"""
+
 # --- QUERY PROCESSING, RETRIEVAL, AND GENERATION ---
 
+@lru_cache(maxsize=2048)
+def _rewrite_query_cached(question: str) -> str:
+    # Raises on API errors so that failed rewrites are never cached
+    prompt = REWRITE_PROMPT_TEMPLATE.format(question=question)
+    response = generation_model.generate_content(prompt)
+    return response.text.strip()
+
 def rewrite_query(question: str) -> str:
     print(f"Rewriting original query: '{question}'")
-    prompt = REWRITE_PROMPT_TEMPLATE.format(question=question)
     try:
-        response = generation_model.generate_content(prompt)
-        rewritten = response.text.strip()
+        rewritten = _rewrite_query_cached(question)
         print(f"Rewritten query: '{rewritten}'")
         return rewritten
     except Exception as e:
         print(f"Warning: Could not rewrite query due to API error. Using original query. Error: {e}")
         return question
 
-def retrieve_and_rerank(question: str, top_k: int = 10, final_k: int = 3):
-    """
-    Performs hybrid search by combining in-memory BM25 and Pinecone semantic search,
-    then re-ranks the fused results.
-    """
-    if bm25_index is None:
-        build_bm25_index_from_file()
-
-    pinecone_index = pc.Index(PINECONE_INDEX_NAME)
-    rewritten_question = rewrite_query(question)
-
-    # 1. Keyword Search (BM25)
-    print("Performing keyword search (BM25)...")
-    tokenized_query = simple_tokenizer(rewritten_question)
-    bm25_scores = bm25_index.get_scores(tokenized_query)
-    bm25_results = sorted(range(len(bm25_scores)), key=lambda i: bm25_scores[i], reverse=True)[:top_k]
-    bm25_hits = [{'id': f'bm25_{i}', 'score': bm25_scores[i], 'metadata': {'full_content': corpus[i]}} for i in bm25_results]
-
-    # 2. Semantic Search (Pinecone)
-    print("Performing semantic search (Pinecone)...")
-    query_embedding = embedding_model.encode(rewritten_question).tolist()
-    pinecone_results = pinecone_index.query(vector=query_embedding, top_k=top_k, include_metadata=True)
-    pinecone_hits = pinecone_results.get('matches', [])
-
-    # 3. Reciprocal Rank Fusion (RRF)
-    print("Fusing results with Reciprocal Rank Fusion...")
-    fused_results = {}
-    k = 60  # RRF ranking constant
-    
-    for rank, hit in enumerate(pinecone_hits):
-        doc_id = hit['id']
-        if doc_id not in fused_results:
-            fused_results[doc_id] = {'score': 0, 'metadata': hit['metadata']}
-        fused_results[doc_id]['score'] += 1 / (k + rank + 1)
-
-    for rank, hit in enumerate(bm25_hits):
-        doc_content = hit['metadata']['full_content']
-        doc_id = f"content_{hash(doc_content)}"
-        if doc_id not in fused_results:
-            fused_results[doc_id] = {'score': 0, 'metadata': hit['metadata']}
-        fused_results[doc_id]['score'] += 1 / (k + rank + 1)
-    
-    sorted_fused_results = sorted(fused_results.values(), key=lambda x: x['score'], reverse=True)
-    
-    # 4. Re-rank the top fused results
+def hybrid_search(dense_vector: list[float], sparse_vector, top_k: int, document_id: str = None) -> list:
+    """
+    Sparse-dense search in a single Pinecone query; Pinecone fuses the keyword
+    and semantic scores server-side. With a `document_id`, only that document's
+    sections are searched.
+    """
+    query_kwargs = {"vector": dense_vector, "top_k": top_k, "include_metadata": True}
+    if document_id is not None:
+        query_kwargs["filter"] = {"document_id": {"$eq": document_id}}
+    if sparse_vector is not None:
+        dense_vector, sparse_vector = hybrid_scale(dense_vector, sparse_vector, HYBRID_ALPHA)
+        query_kwargs.update(vector=dense_vector, sparse_vector=sparse_vector)
+    results = get_pinecone_index().query(**query_kwargs)
+    return results.get('matches', [])
+
+def select_rerank_pool(matches: list, pool_size: int, min_pool_size: int = 0) -> list[str]:
+    """
+    Returns the contents of at most `pool_size` matches for re-ranking. Matches whose
+    score falls below RERANK_MIN_SCORE_RATIO of the best score are dropped,
+    keeping at least `min_pool_size` of them. Matches repeating an earlier
+    match's content are skipped so they are not scored twice.
+    """
+    matches = matches[:pool_size]
+    if not matches:
+        return []
+
+    # Dotproduct hybrid scores can be negative; a ratio of a non-positive best score
+    # would rank above every match, so the cutoff only applies when it is positive.
+    top_score = matches[0]['score']
+    cutoff = RERANK_MIN_SCORE_RATIO * top_score if top_score > 0 else float('-inf')
+    pool = []
+    seen_hashes = set()
+    for match in matches:
+        if match['score'] < cutoff and len(pool) >= min_pool_size:
+            break
+        # Vectors indexed before content hashes were stored fall back to their ID
+        key = match['metadata'].get('content_hash', match['id'])
+        if key in seen_hashes:
+            continue
+        seen_hashes.add(key)
+        pool.append(match['metadata']['full_content'])
+    return pool
+
+def tokenize_rerank_pairs(question: str, pool: list[str]) -> list[dict]:
+    """
+    Builds cross-encoder inputs for (question, candidate) pairs.
+    The question is tokenized once and its ids are reused for every candidate;
+    the candidates are tokenized together in one call, truncated to the room left after the question.
+    """
+    tokenizer = rerank_model.tokenizer
+    max_length = rerank_model.max_length or tokenizer.model_max_length
+    special_tokens = tokenizer.num_special_tokens_to_add(pair=True)
+
+    question_ids = tokenizer(question, add_special_tokens=False)["input_ids"][:max_length // 2]
+    doc_budget = max_length - len(question_ids) - special_tokens
+    doc_ids_list = tokenizer(pool, add_special_tokens=False, truncation=True, max_length=doc_budget)["input_ids"]
+
+    pairs = []
+    for doc_ids in doc_ids_list:
+        input_ids = tokenizer.build_inputs_with_special_tokens(question_ids, doc_ids)
+        features = {"input_ids": input_ids, "attention_mask": [1] * len(input_ids)}
+        if "token_type_ids" in tokenizer.model_input_names:
+            features["token_type_ids"] = tokenizer.create_token_type_ids_from_sequences(question_ids, doc_ids)
+        pairs.append(features)
+    return pairs
+
+def score_rerank_pairs(pairs: list[dict]) -> list[float]:
+    """
+    Runs the cross-encoder directly on pre-tokenized pairs, bypassing CrossEncoder.predict.
+    Returns raw relevance logits; the activation predict() would apply is monotonic, so rankings are unchanged.
+    """
+    scores = []
+    with torch.inference_mode():
+        for start in range(0, len(pairs), RERANK_BATCH_SIZE):
+            batch = rerank_model.tokenizer.pad(pairs[start:start + RERANK_BATCH_SIZE], return_tensors="pt")
+            logits = rerank_model.model(**batch.to(rerank_model.model.device)).logits
+            scores.extend(logits[:, 0].tolist())
+    return scores
+
+def rerank_candidates(questions: list[str], candidate_pools: list[list[str]], final_k: int) -> list[list[str]]:
+    """
+    Scores every (question, candidate) pair in a single cross-encoder pass and
+    keeps the best `final_k` candidates for each question.
+    """
+    rerank_pairs = [
+        pair
+        for question, pool in zip(questions, candidate_pools) if pool
+        for pair in tokenize_rerank_pairs(question, pool)
+    ]
+    if not rerank_pairs:
+        return [[] for _ in questions]
+
+    print(f"Re-ranking {len(rerank_pairs)} candidates across {len(questions)} question(s)...")
+    scores = score_rerank_pairs(rerank_pairs)
+
+    contexts = []
+    offset = 0
+    for pool in candidate_pools:
+        pool_scores = scores[offset:offset + len(pool)]
+        offset += len(pool)
+        reranked_results = sorted(zip(pool, pool_scores), key=lambda x: x[1], reverse=True)
+        contexts.append([content for content, score in reranked_results[:final_k]])
+    return contexts
+
+async def retrieve_and_rerank(question: str, top_k: int = 10, final_k: int = 3, document_id: str = None):
+    """
+    Performs hybrid (BM25 sparse + semantic dense) search in Pinecone, then
+    re-ranks the results with the cross-encoder. With a `document_id`, retrieval
+    is limited to that document; without one, the whole index is searched
+    with dense vectors only.
+    """
+    rewritten_question = await asyncio.to_thread(rewrite_query, question)
+
+    # 1. Hybrid Search (Pinecone sparse-dense)
+    print("Performing hybrid search (Pinecone sparse-dense)...")
+    dense_vector = (await asyncio.to_thread(encode_queries, [rewritten_question]))[0]
+    sparse_vector = (await asyncio.to_thread(encode_sparse_queries, [rewritten_question], document_id))[0]
+    matches = await asyncio.to_thread(hybrid_search, dense_vector, sparse_vector, top_k, document_id)
+
     # OPTIMIZED: Reduce the number of items to re-rank for speed
-    rerank_pool_size = top_k + 5 
-    top_fused_hits = [item['metadata']['full_content'] for item in sorted_fused_results[:rerank_pool_size]]
-    if not top_fused_hits:
+    top_hits = select_rerank_pool(matches, pool_size=top_k, min_pool_size=final_k)
+    if not top_hits:
         return []
         
-    print(f"Re-ranking the top {len(top_fused_hits)} fused results...")
-    rerank_pairs = [[question, content] for content in top_fused_hits]
-    scores = rerank_model.predict(rerank_pairs, show_progress_bar=False)
-    
-    reranked_results = sorted(zip(top_fused_hits, scores), key=lambda x: x[1], reverse=True)
-    
-    final_context = [content for content, score in reranked_results[:final_k]]
+    # 2. Re-rank the top hits
+    final_context = (await asyncio.to_thread(rerank_candidates, [question], [top_hits], final_k))[0]
     print(f"Retrieved and re-ranked {len(final_context)} final context chunks.")
     return final_context
 
-def generate_answer_with_gemini(question: str, context_chunks: list[str]) -> str:
+async def retrieve_and_rerank_batch(questions: list[str], top_k: int = 10, final_k: int = 3, document_id: str = None) -> list[list[str]]:
+    """
+    Batched version of `retrieve_and_rerank`: rewrites and queries Pinecone for all
+    questions concurrently, embeds them in one encode call and re-ranks every
+    (question, candidate) pair in a single cross-encoder pass.
+    """
+    rewritten_questions = list(await asyncio.gather(*(asyncio.to_thread(rewrite_query, q) for q in questions)))
+
+    print(f"Embedding {len(questions)} rewritten queries in one batch...")
+    dense_vectors = await asyncio.to_thread(encode_queries, rewritten_questions)
+    sparse_vectors = await asyncio.to_thread(encode_sparse_queries, rewritten_questions, document_id)
+
+    print("Performing hybrid search (Pinecone sparse-dense) for all questions...")
+    all_matches = await asyncio.gather(*(
+        asyncio.to_thread(hybrid_search, dense_vector, sparse_vector, top_k, document_id)
+        for dense_vector, sparse_vector in zip(dense_vectors, sparse_vectors)
+    ))
+
+    candidate_pools = [select_rerank_pool(matches, pool_size=top_k, min_pool_size=final_k) for matches in all_matches]
+    return await asyncio.to_thread(rerank_candidates, questions, candidate_pools, final_k)
+
+NO_CONTEXT_ANSWER = "I could not find any relevant information in the document to answer this question."
+
+async def generate_answer_with_gemini_async(question: str, context_chunks: list[str]) -> str:
     if not context_chunks:
-        return "I could not find any relevant information in the document to answer this question."
+        return NO_CONTEXT_ANSWER
 
     context_str = "\n\n".join(context_chunks)
     prompt = ANSWER_PROMPT_TEMPLATE.format(context=context_str, question=question)
-    
+
     print("Sending prompt to Gemini for answer generation...")
     try:
-        response = generation_model.generate_content(prompt)
+        response = await generation_model.generate_content_async(prompt)
         print("Successfully received response from Gemini.")
         return response.text.strip()
     except Exception as e:
         print(f"An error occurred while calling the Gemini API: {e}")
         return "Error: Could not generate an answer due to an API issue."
 
-def answer_question(question: str) -> str:
+async def answer_questions_batch(questions: list[str], document_id: str = None) -> list[str]:
     """
-    Main orchestration function for the optimized RAG pipeline.
+    Answers all questions of a request about the document `document_id` with
+    batched retrieval and one consolidated Gemini call. Falls back to one call
+    per question if the batched response cannot be parsed.
     """
-    print(f"\n--- Answering question: '{question}' ---")
-    
-    # The context compression step is now implicitly handled by the final prompt
-    retrieved_context = retrieve_and_rerank(question)
-    answer = generate_answer_with_gemini(question, retrieved_context)
-    
-    print(f"Generated Answer: {answer}")
-    return answer
+    if not questions:
+        return []
+
+    print(f"\n--- Answering {len(questions)} questions in one batch ---")
+    contexts = await retrieve_and_rerank_batch(questions, document_id=document_id)
+
+    question_sections = "\n".join(
+        QUESTION_SECTION_TEMPLATE.format(
+            number=i + 1,
+            question=question,
+            context="\n\n".join(context) if context else "No relevant context was found."
+        )
+        for i, (question, context) in enumerate(zip(questions, contexts))
+    )
+    prompt = BATCH_ANSWER_PROMPT_TEMPLATE.format(question_sections=question_sections)
+
+    print("Sending consolidated prompt to Gemini for answer generation...")
+    try:
+        response = await generation_model.generate_content_async(prompt)
+        response_text = response.text.strip().replace("```json", "").replace("```", "").strip()
+        answers = orjson.loads(response_text)["answers"]
+        if len(answers) != len(questions):
+            raise ValueError(f"expected {len(questions)} answers, got {len(answers)}")
+        print("Successfully received and parsed batched response from Gemini.")
+        return [str(answer).strip() for answer in answers]
+    except Exception as e:
+        print(f"Warning: Batched generation failed, answering questions individually. Error: {e}")
+        return list(await asyncio.gather(*(
+            generate_answer_with_gemini_async(question, context)
+            for question, context in zip(questions, contexts)
+        )))
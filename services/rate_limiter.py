@@ -0,0 +1,31 @@
+import asyncio
+import time
+from collections import deque
+
+
+class RateLimiter:
+    """
+    Proactive sliding-window throttler for API calls.
+    Keeps the timestamps of the calls made in the last `period` seconds and only
+    sleeps when the next call would exceed `max_calls` within that window.
+    """
+
+    def __init__(self, max_calls: int, period: float = 60.0):
+        self.max_calls = max_calls
+        self.period = period
+        self._timestamps = deque()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                # Drop calls that have left the window
+                while self._timestamps and now - self._timestamps[0] >= self.period:
+                    self._timestamps.popleft()
+
+                if len(self._timestamps) < self.max_calls:
+                    self._timestamps.append(now)
+                    return
+
+                await asyncio.sleep(self.period - (now - self._timestamps[0]))